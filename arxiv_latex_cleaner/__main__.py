@@ -21,12 +21,9 @@
 import argparse
 import json
 import logging
-
-import yaml
+import sys
 
 from ._version import __version__
-from .arxiv_latex_cleaner import merge_args_into_config
-from .arxiv_latex_cleaner import run_arxiv_cleaner
 
 PARSER = argparse.ArgumentParser(
     prog="arxiv_latex_cleaner@{0}".format(__version__),
@@ -136,10 +133,7 @@ PARSER.add_argument(
 )
 
 def if_prefixed(orig_string):
-  if orig_string.startswith("\\"):
-    string = orig_string[1:]
-  else:
-    string = orig_string
+  string = orig_string.removeprefix("\\")
   if not string.startswith("if"):
     raise argparse.ArgumentTypeError(
         f"Expected a string starting with 'if', got '{orig_string}'!"
@@ -209,23 +203,34 @@ PARSER.add_argument(
 
 ARGS = vars(PARSER.parse_args())
 
+# Imported only once the arguments are valid, so that `--help` and usage
+# errors do not pay for loading the cleaner and its dependencies.
+from .arxiv_latex_cleaner import merge_args_into_config
+from .arxiv_latex_cleaner import run_arxiv_cleaner
+
 if ARGS["config"] is not None:
+  import yaml
+
+  try:
+    from yaml import CSafeLoader as _YamlLoader
+  except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
   try:
-    with open(ARGS["config"], "r") as config_file:
-      config_params = yaml.safe_load(config_file)
+    with open(ARGS["config"], "rb") as config_file:
+      config_params = yaml.load(config_file, Loader=_YamlLoader)
     final_args = merge_args_into_config(ARGS, config_params)
 
   except FileNotFoundError:
-    print(f"config file {ARGS.config} not found.")
+    print(f"config file {ARGS['config']} not found.")
     final_args = ARGS
     final_args.pop("config", None)
 else:
   final_args = ARGS
 
-if final_args.get("verbose", False):
-  logging.basicConfig(level=logging.INFO)
-else:
-  logging.basicConfig(level=logging.ERROR)
+logging.basicConfig(
+    level=logging.INFO if final_args.get("verbose", False) else logging.ERROR
+)
 
 run_arxiv_cleaner(final_args)
-exit(0)
+sys.exit(0)
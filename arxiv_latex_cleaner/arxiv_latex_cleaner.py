@@ -14,8 +14,9 @@
 # limitations under the License.
 """Cleans the LaTeX code of your paper to submit to arXiv."""
 import collections
+import concurrent.futures
 import contextlib
-import copy
+import functools
 import logging
 import os
 import pathlib
@@ -34,6 +35,20 @@ PDF_RESIZE_COMMAND = (
 )
 MAX_FILENAME_LENGTH = 120
 
+# Patterns that do not depend on the user parameters are compiled only once.
+CONDITIONAL_RE = regex.compile(
+    r'(?!(?<=\\newif\s*))\\if\s*(\w+)|\\else(?!\w)|\\fi(?!\w)'
+)
+AUTO_IGNORE_RE = regex.compile(r'(%\s*auto-ignore).*')
+URL_RE = regex.compile(r'\\url\{(?>[^{}]|(?R))*\}')
+URL_SPLIT_RE = regex.compile('({})'.format(URL_RE.pattern))
+INLINE_COMMENT_RE = regex.compile(r'(?<!\\)%')
+COMMENT_LINE_RE = regex.compile(r'(?m)^[^\n%]*%.*$\n?')
+TIKZ_RE = regex.compile(r'\\tikzsetnextfilename{[\s\S]*?\\end{tikzpicture}')
+TIKZ_FILENAME_RE = regex.compile(r'\\tikzsetnextfilename{(.*?)}')
+INCLUDESVG_RE = regex.compile(r'\\includesvg(\[.*?\])?{(.*?)}')
+WHITESPACE_RE = regex.compile(r'\s+')
+
 # Fix for Windows: Even if '\' (os.sep) is the standard way of making paths on
 # Windows, it interferes with regular expressions. We just change os.sep to '/'
 # and os.path.join to a version using '/' as Windows will handle it the right
@@ -59,38 +74,62 @@ def _create_dir_erase_if_exists(path):
 
 
 def _create_dir_if_not_exists(path):
-  if not os.path.exists(path):
-    os.makedirs(path)
+  os.makedirs(path, exist_ok=True)
+
+
+def _union_regex(patterns):
+  """Returns one compiled regex matching any of 'patterns', or None."""
+  if not patterns:
+    return None
+  return regex.compile('|'.join('(?:{})'.format(p) for p in patterns))
 
 
 def _keep_pattern(haystack, patterns_to_keep):
   """Keeps the strings that match 'patterns_to_keep'."""
-  out = []
-  for item in haystack:
-    if any((regex.findall(rem, item) for rem in patterns_to_keep)):
-      out.append(item)
-  return out
+  union = _union_regex(patterns_to_keep)
+  if union is None:
+    return []
+  return [item for item in haystack if union.search(item)]
 
 
 def _remove_pattern(haystack, patterns_to_remove):
   """Removes the strings that match 'patterns_to_remove'."""
-  return [
-      item
-      for item in haystack
-      if item not in _keep_pattern([item], patterns_to_remove)
-  ]
+  union = _union_regex(patterns_to_remove)
+  if union is None:
+    return list(haystack)
+  return [item for item in haystack if not union.search(item)]
+
+
+def _scan_files(folder, prefix, ignore_dirs):
+  """Yields the regular files under 'folder', as paths prefixed with 'prefix'.
+
+  Like os.walk, symlinks to directories are not followed and unreadable
+  directories are skipped. Like os.path.isfile, broken symlinks and special
+  files are left out. Directories matching the compiled 'ignore_dirs'
+  regex, if any, are pruned.
+  """
+  try:
+    with os.scandir(folder) as it:
+      entries = list(it)
+  except OSError:
+    return
+  subfolders = []
+  for entry in entries:
+    if entry.is_dir():
+      if not entry.is_symlink():
+        subfolders.append(entry)
+    elif entry.is_file():
+      yield prefix + entry.name
+  for entry in subfolders:
+    subfolder_prefix = prefix + entry.name + os.sep
+    if ignore_dirs is None or not ignore_dirs.search(subfolder_prefix):
+      yield from _scan_files(entry.path, subfolder_prefix, ignore_dirs)
 
 
 def _list_all_files(in_folder, ignore_dirs=None):
   if ignore_dirs is None:
     ignore_dirs = []
-  to_consider = [
-      os.path.join(os.path.relpath(path, in_folder), name)
-      if path != in_folder
-      else name
-      for path, _, files in os.walk(in_folder)
-      for name in files
-  ]
+  to_consider = list(_scan_files(in_folder, '', _union_regex(ignore_dirs)))
   return _remove_pattern(to_consider, ignore_dirs)
 
 
@@ -98,83 +137,90 @@ def _copy_file(filename, params):
   _create_dir_if_not_exists(
       os.path.join(params['output_folder'], os.path.dirname(filename))
   )
-  shutil.copy(
+  shutil.copyfile(
       os.path.join(params['input_folder'], filename),
       os.path.join(params['output_folder'], filename),
   )
 
 
-def _remove_command(text, command, keep_text=False):
-  """Removes '\\command{*}' from the string 'text'.
+@functools.lru_cache(maxsize=1024)
+def _command_regex(command):
+  """Returns the compiled regex matching '\\command[*]{*}[*]'.
 
-  Regex `base_pattern` used to match balanced parentheses taken from:
+  Regex used to match balanced parentheses taken from:
   https://stackoverflow.com/questions/546433/regular-expression-to-match-balanced-parentheses/35271017#35271017
+
+  The quantifiers are possessive and the leading optional arguments are a
+  single lazy group, so that unbalanced braces or brackets cannot trigger
+  catastrophic backtracking.
   """
-  base_pattern = (
+  return regex.compile(
       r'\\'
       + command
-      + r'(?:\[(?:.*?)\])*\{((?:[^{}]+|\{(?1)\})*)\}(?:\[(?:.*?)\])*'
+      + r'(?:\[.*?\])?\{(?P<argument>(?:[^{}]++|\{(?&argument)\})*+)\}'
+      + r'(?:\[.*?\])*'
   )
 
-  def extract_text_inside_curly_braces(text):
-    """Extract text inside of {} from command string"""
-    pattern = r'\{((?:[^{}]|(?R))*)\}'
-
-    match = regex.search(pattern, text)
 
-    if match:
-      return match.group(1)
-    else:
-      return ''
-
-  # Loops in case of nested commands that need to retain text, e.g.,
-  # \red{hello \red{world}}.
-  while True:
-    all_substitutions = []
-    has_match = False
-    for match in regex.finditer(base_pattern, text):
-      # In case there are only spaces or nothing up to the following newline,
-      # adds a percent, not to alter the newlines.
-      has_match = True
-
-      if not keep_text:
-        new_substring = ''
-      else:
-        temp_substring = text[match.span()[0] : match.span()[1]]
-        new_substring = extract_text_inside_curly_braces(temp_substring)
-
-      if match.span()[1] < len(text):
-        next_newline = text[match.span()[1] :].find('\n')
-        if next_newline != -1:
-          text_until_newline = text[
-              match.span()[1] : match.span()[1] + next_newline
-          ]
-          if (
-              not text_until_newline or text_until_newline.isspace()
-          ) and not keep_text:
-            new_substring = '%'
-      all_substitutions.append(
-          (match.span()[0], match.span()[1], new_substring)
+@functools.lru_cache(maxsize=1024)
+def _environments_regex(environments):
+  """Returns the compiled regex matching any of the whole 'environments'."""
+  # Need to escape '{', to not trigger fuzzy matching if `environment` starts
+  # with one of 'i', 'd', 's', or 'e'
+  return regex.compile(
+      '|'.join(
+          r'(?:\\begin\{' + env + r'}[\s\S]*?\\end\{' + env + r'})'
+          for env in environments
       )
+  )
 
-    for start, end, new_substring in reversed(all_substitutions):
-      text = text[:start] + new_substring + text[end:]
-
-    if not keep_text or not has_match:
-      break
 
-  return text
+def _remove_command(text, command, keep_text=False):
+  """Removes '\\command{*}' from the string 'text'."""
+  command_regex = _command_regex(command)
+
+  if keep_text:
+    # Recurses into the kept text in case of nested commands, e.g.,
+    # \red{hello \red{world}}.
+    def keep_argument(match):
+      return command_regex.sub(keep_argument, match.group('argument'))
+
+    return command_regex.sub(keep_argument, text)
+
+  pieces = []
+  position = 0
+  for match in command_regex.finditer(text):
+    # In case there are only spaces or nothing up to the following newline,
+    # adds a percent, not to alter the newlines.
+    new_substring = ''
+    next_newline = text.find('\n', match.end())
+    if next_newline != -1 and (
+        match.end() == next_newline
+        or text[match.end() : next_newline].isspace()
+    ):
+      new_substring = '%'
+    pieces.append(text[position : match.start()])
+    pieces.append(new_substring)
+    position = match.end()
+  pieces.append(text[position:])
+  return ''.join(pieces)
+
+
+def _remove_commands(text, commands, keep_text=False):
+  """Removes all the 'commands' from 'text' in a single pass."""
+  return _remove_command(text, '(?:' + '|'.join(commands) + ')', keep_text)
 
 
 def _remove_environment(text, environment):
   """Removes '\\begin{environment}*\\end{environment}' from 'text'."""
-  # Need to escape '{', to not trigger fuzzy matching if `environment` starts
-  # with one of 'i', 'd', 's', or 'e'
-  return regex.sub(
-      r'\\begin\{' + environment + r'}[\s\S]*?\\end\{' + environment + r'}',
-      '',
-      text,
-  )
+  return _remove_environments(text, [environment])
+
+
+def _remove_environments(text, environments):
+  """Removes all the 'environments' from 'text' in a single pass."""
+  if '\\begin{' not in text:
+    return text
+  return _environments_regex(tuple(environments)).sub('', text)
 
 
 def _simplify_conditional_blocks(text, if_exceptions=[]):
@@ -187,7 +233,9 @@ def _simplify_conditional_blocks(text, if_exceptions=[]):
   If the conditional tree is malformed, the function will print a warning
   to stderr and return the original text.
   """
-  p = regex.compile(r'(?!(?<=\\newif\s*))\\if\s*(\w+)|\\else(?!\w)|\\fi(?!\w)')
+  if '\\if' not in text and '\\else' not in text and '\\fi' not in text:
+    return text
+
   toplevel_tree = {'left': [], 'right': [], 'kind': 'toplevel', 'parent': None}
 
   tree = toplevel_tree
@@ -287,7 +335,7 @@ def _simplify_conditional_blocks(text, if_exceptions=[]):
         f" --if_exceptions'.\n"
     )
 
-  for m in p.finditer(text):
+  for m in CONDITIONAL_RE.finditer(text):
     m_no_space = m.group().replace(' ', '')
     if m_no_space == r'\iffalse' or m_no_space == r'\if0':
       subtree = new_subtree('iffalse')
@@ -331,72 +379,80 @@ def _simplify_conditional_blocks(text, if_exceptions=[]):
 
   positions_to_delete = []
 
-  def traverse_tree(tree):
+  # Walks the tree with an explicit stack, so that deeply nested conditionals
+  # cannot hit the recursion limit.
+  stack = list(reversed(toplevel_tree['left']))
+  while stack:
+    tree = stack.pop()
     if tree['kind'] == 'iffalse':
       if 'else' in tree:
         positions_to_delete.append((tree['start'].start(), tree['else'].end()))
-        for subtree in tree['right']:
-          traverse_tree(subtree)
+        stack.extend(reversed(tree['right']))
         positions_to_delete.append((tree['end'].start(), tree['end'].end()))
       else:
         positions_to_delete.append((tree['start'].start(), tree['end'].end()))
     elif tree['kind'] == 'iftrue':
       if 'else' in tree:
         positions_to_delete.append((tree['start'].start(), tree['start'].end()))
-        for subtree in tree['left']:
-          traverse_tree(subtree)
+        stack.extend(reversed(tree['left']))
         positions_to_delete.append((tree['else'].start(), tree['end'].end()))
       else:
         positions_to_delete.append((tree['start'].start(), tree['start'].end()))
         positions_to_delete.append((tree['end'].start(), tree['end'].end()))
     elif tree['kind'] == 'unknown':
-      for subtree in tree['left']:
-        traverse_tree(subtree)
-      for subtree in tree['right']:
-        traverse_tree(subtree)
+      stack.extend(reversed(tree['left'] + tree['right']))
     else:
       raise ValueError('Unreachable!')
+  positions_to_delete.sort()
 
-  for tree in toplevel_tree['left']:
-    traverse_tree(tree)
-
+  # Each deletion also eats one whitespace character following it, as seen
+  # after the later deletions, so adjacent spans are merged back to front.
+  spans_to_delete = []
   for start, end in reversed(positions_to_delete):
+    while spans_to_delete and spans_to_delete[-1][0] == end:
+      end = spans_to_delete.pop()[1]
     if end < len(text) and text[end].isspace():
-      end_to_del = end + 1
-    else:
-      end_to_del = end
-    text = text[:start] + text[end_to_del:]
+      end += 1
+      while spans_to_delete and spans_to_delete[-1][0] == end:
+        end = spans_to_delete.pop()[1]
+    spans_to_delete.append((start, end))
 
-  return text
+  pieces = []
+  position = 0
+  for start, end in reversed(spans_to_delete):
+    pieces.append(text[position:start])
+    position = end
+  pieces.append(text[position:])
+  return ''.join(pieces)
 
 
 def _remove_comments_inline(text):
   """Removes the comments from the string 'text' and ignores % inside \\url{}."""
-  auto_ignore_pattern = r'(%\s*auto-ignore).*'
-  if regex.search(auto_ignore_pattern, text):
-    return regex.sub(auto_ignore_pattern, r'\1', text)
+  if '%' not in text:
+    return text if text.endswith('\n') or text.endswith('\\n') else text + '\n'
+
+  if AUTO_IGNORE_RE.search(text):
+    return AUTO_IGNORE_RE.sub(r'\1', text)
 
   if text.lstrip(' ').lstrip('\t').startswith('%'):
     return ''
 
-  url_pattern = r'\\url\{(?>[^{}]|(?R))*\}'
-
   def remove_comments(segment):
     """Check if a segment of text contains a comment and remove it."""
     if segment.lstrip().startswith('%'):
       return '', True
-    match = regex.search(r'(?<!\\)%', segment)
+    match = INLINE_COMMENT_RE.search(segment)
     if match:
       return segment[: match.end()] + '\n', True
     else:
       return segment, False
 
   # split the text into segments based on \url{} tags
-  segments = regex.split(f'({url_pattern})', text)
+  segments = URL_SPLIT_RE.split(text)
 
   for i in range(len(segments)):
     # only process segments that are not part of a \url{} tag
-    if not regex.match(url_pattern, segments[i]):
+    if not URL_RE.match(segments[i]):
       segments[i], match = remove_comments(segments[i])
       if match:
         # remove all segments after the first inline comment
@@ -411,22 +467,36 @@ def _remove_comments_inline(text):
   )
 
 
-def _strip_tex_contents(lines, end_str):
-  """Removes everything after end_str."""
-  for i in range(len(lines)):
-    if end_str in lines[i]:
-      if '%' not in lines[i]:
-        return lines[: i + 1]
-      elif lines[i].index('%') > lines[i].index(end_str):
-        return lines[: i + 1]
-  return lines
+def _remove_comments(text):
+  """Removes the comments from every line of 'text' in a single pass."""
+  if '%' in text:
+    text = COMMENT_LINE_RE.sub(
+        lambda match: _remove_comments_inline(match.group(0)), text
+    )
+  if not text or text.endswith('\n') or text.endswith('\\n'):
+    return text
+  # Like _remove_comments_inline, leave an unterminated auto-ignore line as is.
+  if AUTO_IGNORE_RE.search(text, text.rfind('\n') + 1):
+    return text
+  return text + '\n'
+
+
+def _strip_tex_contents(text, end_str):
+  """Removes everything after the line with an uncommented end_str."""
+  position = text.find(end_str)
+  while position != -1:
+    line_start = text.rfind('\n', 0, position) + 1
+    line_end = text.find('\n', position) + 1 or len(text)
+    line = text[line_start:line_end]
+    if '%' not in line or line.index('%') > line.index(end_str):
+      return text[:line_end]
+    position = text.find(end_str, line_end)
+  return text
 
 
 def _read_file_content(filename):
   with open(filename, 'r', encoding='utf-8') as fp:
-    lines = fp.readlines()
-    lines = _strip_tex_contents(lines, '\\end{document}')
-    return lines
+    return _strip_tex_contents(fp.read(), '\\end{document}')
 
 
 def _read_all_tex_contents(tex_files, parameters):
@@ -446,17 +516,23 @@ def _write_file_content(content, filename):
 
 def _remove_comments_and_commands_to_delete(content, parameters):
   """Erases all LaTeX comments in the content, and writes it."""
-  content = [_remove_comments_inline(line) for line in content]
-  content = _remove_environment(''.join(content), 'comment')
+  content = _remove_comments(content)
+  content = _remove_environment(content, 'comment')
   content = _simplify_conditional_blocks(
       content, parameters.get('if_exceptions', [])
   )
-  for environment in parameters.get('environments_to_delete', []):
-    content = _remove_environment(content, environment)
-  for command in parameters.get('commands_only_to_delete', []):
-    content = _remove_command(content, command, True)
-  for command in parameters['commands_to_delete']:
-    content = _remove_command(content, command, False)
+  if parameters.get('environments_to_delete'):
+    content = _remove_environments(
+        content, parameters['environments_to_delete']
+    )
+  if parameters.get('commands_only_to_delete'):
+    content = _remove_commands(
+        content, parameters['commands_only_to_delete'], True
+    )
+  if parameters['commands_to_delete']:
+    content = _remove_commands(
+        content, parameters['commands_to_delete'], False
+    )
   return content
 
 
@@ -465,11 +541,11 @@ def _replace_tikzpictures(content, figures):
 
   external PDF figures) in the content, and writes it.
   """
+  if '\\tikzsetnextfilename{' not in content:
+    return content
 
   def get_figure(matchobj):
-    found_tikz_filename = regex.search(
-        r'\\tikzsetnextfilename{(.*?)}', matchobj.group(0)
-    ).group(1)
+    found_tikz_filename = TIKZ_FILENAME_RE.search(matchobj.group(0)).group(1)
     # search in tex split if figure is available
     matching_tikz_filenames = _keep_pattern(
         figures, ['/' + found_tikz_filename + '.pdf']
@@ -479,14 +555,15 @@ def _replace_tikzpictures(content, figures):
     else:
       return matchobj.group(0)
 
-  content = regex.sub(
-      r'\\tikzsetnextfilename{[\s\S]*?\\end{tikzpicture}', get_figure, content
-  )
+  content = TIKZ_RE.sub(get_figure, content)
 
   return content
 
 
 def _replace_includesvg(content, svg_inkscape_files):
+  if '\\includesvg' not in content:
+    return content
+
   def repl_svg(matchobj):
     svg_path = matchobj.group(2)
     if svg_path.endswith('.svg'):
@@ -504,7 +581,7 @@ def _replace_includesvg(content, svg_inkscape_files):
     else:
       return matchobj.group(0)
 
-  content = regex.sub(r'\\includesvg(\[.*?\])?{(.*?)}', repl_svg, content)
+  content = INCLUDESVG_RE.sub(repl_svg, content)
 
   return content
 
@@ -522,32 +599,33 @@ def _resize_and_copy_figure(
   _create_dir_if_not_exists(
       os.path.join(destination_folder, os.path.dirname(filename))
   )
+  extension = os.path.splitext(filename)[1].lower()
+  origin_file = os.path.join(origin_folder, filename)
+  destination_file = os.path.join(destination_folder, filename)
 
-  if resize_image and os.path.splitext(filename)[1].lower() in [
-      '.jpg',
-      '.jpeg',
-      '.png',
-  ]:
-    im = Image.open(os.path.join(origin_folder, filename))
+  if resize_image and extension in ('.jpg', '.jpeg', '.png'):
+    im = Image.open(origin_file)
     if max(im.size) > image_size:
-      im = im.resize(
-          tuple([int(x * float(image_size) / max(im.size)) for x in im.size]),
-          Image.Resampling.LANCZOS,
+      new_size = tuple(
+          [int(x * float(image_size) / max(im.size)) for x in im.size]
       )
-    if os.path.splitext(filename)[1].lower() in ['.jpg', '.jpeg']:
-      im.save(os.path.join(destination_folder, filename), 'JPEG', quality=90)
-    elif os.path.splitext(filename)[1].lower() in ['.png']:
-      im.save(os.path.join(destination_folder, filename), 'PNG')
-
-  elif compress_pdf and os.path.splitext(filename)[1].lower() == '.pdf':
+      # Lets the JPEG decoder downscale by a power of two while decoding, to
+      # avoid decoding the full image. The decoder only box-averages, so it
+      # stops at twice the target size (as Image.thumbnail does) and LANCZOS
+      # does the last step. This is a no-op for other formats.
+      im.draft(im.mode, tuple(2 * x for x in new_size))
+      im = im.resize(new_size, Image.Resampling.LANCZOS)
+    if extension in ('.jpg', '.jpeg'):
+      im.save(destination_file, 'JPEG', quality=90)
+    elif extension == '.png':
+      im.save(destination_file, 'PNG')
+
+  elif compress_pdf and extension == '.pdf':
     _resize_pdf_figure(
         filename, origin_folder, destination_folder, pdf_resolution
     )
   else:
-    shutil.copy(
-        os.path.join(origin_folder, filename),
-        os.path.join(destination_folder, filename),
-    )
+    shutil.copyfile(origin_file, destination_file)
 
 
 def _resize_pdf_figure(
@@ -583,22 +661,35 @@ def _resize_and_copy_figures_if_referenced(parameters, contents, splits):
       lambda: parameters['pdf_im_resolution']
   )
   pdf_resolution.update(parameters['images_allowlist'])
-  for image_file in _keep_only_referenced(
-      splits['figures'], contents, strict=False
-  ):
-    _resize_and_copy_figure(
-        filename=image_file,
-        origin_folder=parameters['input_folder'],
-        destination_folder=parameters['output_folder'],
-        resize_image=parameters['resize_images'],
-        image_size=image_size[image_file],
-        compress_pdf=parameters['compress_pdf'],
-        pdf_resolution=pdf_resolution[image_file],
-    )
-
-
-def _search_reference(filename, contents, strict=False):
-  """Returns a match object if filename is referenced in contents, and None otherwise.
+  # Most of the work happens in Pillow and in the ghostscript subprocesses,
+  # so the figures are processed concurrently in threads. There is at most one
+  # worker per core, so that the ghostscript processes are not slowed past
+  # their timeout.
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=os.cpu_count()
+  ) as executor:
+    futures = [
+        executor.submit(
+            _resize_and_copy_figure,
+            filename=image_file,
+            origin_folder=parameters['input_folder'],
+            destination_folder=parameters['output_folder'],
+            resize_image=parameters['resize_images'],
+            image_size=image_size[image_file],
+            compress_pdf=parameters['compress_pdf'],
+            pdf_resolution=pdf_resolution[image_file],
+        )
+        for image_file in _keep_only_referenced(
+            splits['figures'], contents, strict=False
+        )
+    ]
+    for future in futures:
+      future.result()
+
+
+@functools.lru_cache(maxsize=1024)
+def _reference_regex(filename, strict):
+  """Returns the compiled regex matching a reference to filename.
 
   If not strict mode, path prefix and extension are optional.
   """
@@ -636,7 +727,15 @@ def _search_reference(filename, contents, strict=False):
   # Pads with braces and optional whitespace/comment characters.
   patn = r'\{{[\s%]*{}[\s%]*\}}'.format(filename_regex)
   # Picture references in LaTeX are allowed to be in different cases.
-  return regex.search(patn, contents, regex.IGNORECASE)
+  return regex.compile(patn, regex.IGNORECASE)
+
+
+def _search_reference(filename, contents, strict=False):
+  """Returns a match object if filename is referenced in contents, and None otherwise.
+
+  If not strict mode, path prefix and extension are optional.
+  """
+  return _reference_regex(filename, strict).search(contents)
 
 
 def _keep_only_referenced(filenames, contents, strict=False):
@@ -644,10 +743,21 @@ def _keep_only_referenced(filenames, contents, strict=False):
 
   If not strict mode, path prefix and extension are optional.
   """
+  # A file can only be referenced if its stem appears in the contents, which
+  # is much cheaper to check than the full reference regex. This only holds
+  # for ASCII stems, and once the two Turkish i's that IGNORECASE matches
+  # against 'i' are folded to it, since casefold() does not do so.
+  folded_contents = contents.translate({0x130: 'i', 0x131: 'i'}).casefold()
+
+  def may_be_referenced(fn):
+    stem = pathlib.Path(fn).stem
+    return not stem.isascii() or stem.casefold() in folded_contents
+
   return [
       fn
       for fn in filenames
-      if _search_reference(fn, contents, strict) is not None
+      if (strict or may_be_referenced(fn))
+      and _search_reference(fn, contents, strict) is not None
   ]
 
 
@@ -657,21 +767,36 @@ def _keep_only_referenced_tex(contents, splits):
   It needs various iterations in case one file is referenced from an
   unreferenced file.
   """
-  old_referenced = set(splits['tex_in_root'] + splits['tex_not_in_root'])
+  all_tex = splits['tex_in_root'] + splits['tex_not_in_root']
+  roots = collections.defaultdict(list)
+  for fn in all_tex:
+    roots[os.path.splitext(fn)[0]].append(fn)
+  reference_regexes = {
+      root: regex.compile(regex.escape(root) + r'[.}]') for root in roots
+  }
+  referenced_from = {fn: set() for fn in all_tex}
+  for fn2 in all_tex:
+    text = contents[fn2]
+    # Every root is searched on its own, since one root can be a prefix of
+    # another and both may be referenced at the same position. The substring
+    # check skips the regex for the (many) roots that cannot match.
+    for root, reference_regex in reference_regexes.items():
+      if root in text and reference_regex.search(text):
+        for fn in roots[root]:
+          referenced_from[fn].add(fn2)
+
+  old_referenced = set(all_tex)
   while True:
     referenced = set(splits['tex_in_root'])
     for fn in old_referenced:
-      for fn2 in old_referenced:
-        if regex.search(
-            r'(' + os.path.splitext(fn)[0] + r'[.}])', '\n'.join(contents[fn2])
-        ):
-          referenced.add(fn)
+      if not referenced_from[fn].isdisjoint(old_referenced):
+        referenced.add(fn)
 
     if referenced == old_referenced:
       splits['tex_to_copy'] = list(referenced)
       return
 
-    old_referenced = referenced.copy()
+    old_referenced = referenced
 
 
 def _add_root_tex_files(splits):
@@ -690,16 +815,11 @@ def _split_all_files(parameters):
       'all': _list_all_files(
           parameters['input_folder'], ignore_dirs=['.git' + os.sep]
       ),
-      'in_root': [
-          f
-          for f in os.listdir(parameters['input_folder'])
-          if os.path.isfile(os.path.join(parameters['input_folder'], f))
-      ],
   }
 
-  file_splits['not_in_root'] = [
-      f for f in file_splits['all'] if f not in file_splits['in_root']
-  ]
+  # Relative paths of the files in the root folder have no separator.
+  file_splits['in_root'] = [f for f in file_splits['all'] if os.sep not in f]
+  file_splits['not_in_root'] = [f for f in file_splits['all'] if os.sep in f]
   file_splits['to_copy_in_root'] = _remove_pattern(
       file_splits['in_root'],
       parameters['to_delete'] + parameters['figures_to_copy_if_referenced'],
@@ -743,9 +863,29 @@ def _split_all_files(parameters):
   return file_splits
 
 
-def _create_out_folder(input_folder):
-  """Creates the output folder, erasing it if existed."""
-  out_folder = os.path.abspath(input_folder).removesuffix('.zip') + '_arXiv'
+def _is_same_or_inside(path, folder):
+  """Whether path is folder or inside it (never true across drives)."""
+  return path.is_relative_to(folder)
+
+
+def _create_out_folder(input_folder, output_folder=None):
+  """Creates the output folder, erasing it if existed.
+
+  Unless given, the output folder is the input folder with an '_arXiv' suffix.
+  An output folder that is the input folder or contains it is refused, since
+  erasing it would delete the sources.
+  """
+  if output_folder is None:
+    out_folder = os.path.abspath(input_folder).removesuffix('.zip') + '_arXiv'
+  else:
+    out_folder = os.path.abspath(output_folder)
+  if _is_same_or_inside(
+      pathlib.Path(os.path.realpath(input_folder)),
+      pathlib.Path(os.path.realpath(out_folder)),
+  ):
+    raise ValueError(
+        f'Output folder {out_folder} would erase the input {input_folder}.'
+    )
   _create_dir_erase_if_exists(out_folder)
 
   return out_folder
@@ -792,7 +932,9 @@ def run_arxiv_cleaner(parameters):
   })
 
   logging.info('Collecting file structure.')
-  parameters['output_folder'] = _create_out_folder(parameters['input_folder'])
+  parameters['output_folder'] = _create_out_folder(
+      parameters['input_folder'], parameters.get('output_folder')
+  )
 
   from_zip = parameters['input_folder'].endswith('.zip')
   tempdir_context = (
@@ -827,21 +969,18 @@ def run_arxiv_cleaner(parameters):
 
     for tex_file in tex_contents:
       logging.info('Replacing Tikz Pictures in file %s.', tex_file)
-      content = _replace_tikzpictures(
+      tex_contents[tex_file] = _replace_tikzpictures(
           tex_contents[tex_file], splits['external_tikz_figures']
       )
-      # If file ends with '\n' already, the split in last line would add an extra
-      # '\n', so we remove it.
-      tex_contents[tex_file] = content.split('\n')
 
     _keep_only_referenced_tex(tex_contents, splits)
     _add_root_tex_files(splits)
 
     for tex_file in splits['tex_to_copy']:
       logging.info('Replacing patterns in file %s.', tex_file)
-      content = '\n'.join(tex_contents[tex_file])
       content = _find_and_replace_patterns(
-          content, parameters.get('patterns_and_insertions', list())
+          tex_contents[tex_file],
+          parameters.get('patterns_and_insertions', list()),
       )
       tex_contents[tex_file] = content
       new_path = os.path.join(parameters['output_folder'], tex_file)
@@ -851,9 +990,7 @@ def run_arxiv_cleaner(parameters):
           new_path,
       )
 
-    full_content = '\n'.join(
-        ''.join(tex_contents[fn]) for fn in splits['tex_to_copy']
-    )
+    full_content = '\n'.join(tex_contents[fn] for fn in splits['tex_to_copy'])
     _copy_only_referenced_non_tex_not_in_root(parameters, full_content, splits)
     for non_tex_file in splits['non_tex_in_root']:
       logging.info('Copying non-tex file %s.', non_tex_file)
@@ -868,13 +1005,12 @@ def strip_whitespace(text):
 
   https://stackoverflow.com/questions/8270092/remove-all-whitespace-in-a-string
   """
-  pattern = regex.compile(r'\s+')
-  text = regex.sub(pattern, '', text)
-  return text
+  return WHITESPACE_RE.sub('', text)
 
 
 def merge_args_into_config(args, config_params):
-  final_args = copy.deepcopy(config_params)
+  # Nested values are never mutated in place, so a shallow copy is enough.
+  final_args = dict(config_params)
   config_keys = config_params.keys()
   for key, value in args.items():
     if key in config_keys:
@@ -886,7 +1022,7 @@ def merge_args_into_config(args, config_params):
         final_args[key] = value + config_params[key]
       elif isinstance(value, dict):
         # Updates config params with args params.
-        final_args[key].update(**value)
+        final_args[key] = {**config_params[key], **value}
     else:
       final_args[key] = value
   return final_args
@@ -915,14 +1051,19 @@ def _find_and_replace_patterns(content, patterns_and_insertions):
     description = pattern_and_insertion['description']
     logging.info('Processing pattern: %s.', description)
     p = regex.compile(pattern)
-    m = p.search(content)
-    while m is not None:
+
+    def replace(m):
       local_insertion = insertion.format(**m.groupdict())
       if pattern_and_insertion.get('strip_whitespace', True):
         local_insertion = strip_whitespace(local_insertion)
-      logging.info(f'Found {content[m.start():m.end()]:<70}')
-      logging.info(f'Replacing with {local_insertion:<30}')
-      content = content[: m.start()] + local_insertion + content[m.end() :]
-      m = p.search(content)
+      logging.info('Found %-70s', m.group())
+      logging.info('Replacing with %-30s', local_insertion)
+      return local_insertion
+
+    # Repeat until nothing matches, so that a macro whose argument contained
+    # another (now expanded) macro gets replaced as well.
+    num_replaced = 1
+    while num_replaced:
+      content, num_replaced = p.subn(replace, content)
     logging.info('Finished pattern: %s.', description)
   return content
@@ -13,8 +13,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import filecmp
+import os
 from os import path
+import pathlib
 import shutil
+import tempfile
 import unittest
 from absl.testing import parameterized
 from arxiv_latex_cleaner import arxiv_latex_cleaner
@@ -83,146 +87,159 @@ def make_patterns():
   return [output]
 
 
-def make_search_reference_tests():
-  return (
-      {
-          'testcase_name': 'prefix1',
-          'filenames': ['include_image_yes.png', 'include_image.png'],
-          'contents': '\\include{include_image_yes.png}',
-          'strict': False,
-          'true_outputs': ['include_image_yes.png'],
-      },
-      {
-          'testcase_name': 'prefix2',
-          'filenames': ['include_image_yes.png', 'include_image.png'],
-          'contents': '\\include{include_image.png}',
-          'strict': False,
-          'true_outputs': ['include_image.png'],
-      },
-      {
-          'testcase_name': 'nested_more_specific',
-          'filenames': [
-              'images/im_included.png',
-              'images/include/images/im_included.png',
-          ],
-          'contents': '\\include{images/include/images/im_included.png}',
-          'strict': False,
-          'true_outputs': ['images/include/images/im_included.png'],
-      },
-      {
-          'testcase_name': 'nested_less_specific',
-          'filenames': [
-              'images/im_included.png',
-              'images/include/images/im_included.png',
-          ],
-          'contents': '\\include{images/im_included.png}',
-          'strict': False,
-          'true_outputs': [
-              'images/im_included.png',
-              'images/include/images/im_included.png',
-          ],
-      },
-      {
-          'testcase_name': 'nested_substring',
-          'filenames': ['images/im_included.png', 'im_included.png'],
-          'contents': '\\include{images/im_included.png}',
-          'strict': False,
-          'true_outputs': ['images/im_included.png'],
-      },
-      {
-          'testcase_name': 'nested_diffpath',
-          'filenames': ['images/im_included.png', 'figures/im_included.png'],
-          'contents': '\\include{images/im_included.png}',
-          'strict': False,
-          'true_outputs': ['images/im_included.png'],
-      },
-      {
-          'testcase_name': 'diffext',
-          'filenames': ['tables/demo.tex', 'tables/demo.tikz', 'demo.tex'],
-          'contents': '\\include{tables/demo.tex}',
-          'strict': False,
-          'true_outputs': ['tables/demo.tex'],
-      },
-      {
-          'testcase_name': 'diffext2',
-          'filenames': ['tables/demo.tex', 'tables/demo.tikz', 'demo.tex'],
-          'contents': '\\include{tables/demo}',
-          'strict': False,
-          'true_outputs': ['tables/demo.tex', 'tables/demo.tikz'],
-      },
-      {
-          'testcase_name': 'strict_prefix1',
-          'filenames': ['demo_yes.tex', 'demo.tex'],
-          'contents': '\\include{demo_yes.tex}',
-          'strict': True,
-          'true_outputs': ['demo_yes.tex'],
-      },
-      {
-          'testcase_name': 'strict_prefix2',
-          'filenames': ['demo_yes.tex', 'demo.tex'],
-          'contents': '\\include{demo.tex}',
-          'strict': True,
-          'true_outputs': ['demo.tex'],
-      },
-      {
-          'testcase_name': 'strict_nested_more_specific',
-          'filenames': [
-              'tables/table_included.csv',
-              'tables/include/tables/table_included.csv',
-          ],
-          'contents': '\\include{tables/include/tables/table_included.csv}',
-          'strict': True,
-          'true_outputs': ['tables/include/tables/table_included.csv'],
-      },
-      {
-          'testcase_name': 'strict_nested_less_specific',
-          'filenames': [
-              'tables/table_included.csv',
-              'tables/include/tables/table_included.csv',
-          ],
-          'contents': '\\include{tables/table_included.csv}',
-          'strict': True,
-          'true_outputs': ['tables/table_included.csv'],
-      },
-      {
-          'testcase_name': 'strict_nested_substring1',
-          'filenames': ['tables/table_included.csv', 'table_included.csv'],
-          'contents': '\\include{tables/table_included.csv}',
-          'strict': True,
-          'true_outputs': ['tables/table_included.csv'],
-      },
-      {
-          'testcase_name': 'strict_nested_substring2',
-          'filenames': ['tables/table_included.csv', 'table_included.csv'],
-          'contents': '\\include{table_included.csv}',
-          'strict': True,
-          'true_outputs': ['table_included.csv'],
-      },
-      {
-          'testcase_name': 'strict_nested_diffpath',
-          'filenames': ['tables/table_included.csv', 'data/table_included.csv'],
-          'contents': '\\include{tables/table_included.csv}',
-          'strict': True,
-          'true_outputs': ['tables/table_included.csv'],
-      },
-      {
-          'testcase_name': 'strict_diffext',
-          'filenames': ['tables/demo.csv', 'tables/demo.txt', 'demo.csv'],
-          'contents': '\\include{tables/demo.csv}',
-          'strict': True,
-          'true_outputs': ['tables/demo.csv'],
-      },
-      {
-          'testcase_name': 'path_starting_with_dot',
-          'filenames': [
-              './images/im_included.png',
-              './figures/im_included.png',
-          ],
-          'contents': '\\include{./images/im_included.png}',
-          'strict': False,
-          'true_outputs': ['./images/im_included.png'],
-      },
-  )
+SEARCH_REFERENCE_TESTS = (
+    {
+        'testcase_name': 'prefix1',
+        'filenames': ['include_image_yes.png', 'include_image.png'],
+        'contents': '\\include{include_image_yes.png}',
+        'strict': False,
+        'true_outputs': ['include_image_yes.png'],
+    },
+    {
+        'testcase_name': 'prefix2',
+        'filenames': ['include_image_yes.png', 'include_image.png'],
+        'contents': '\\include{include_image.png}',
+        'strict': False,
+        'true_outputs': ['include_image.png'],
+    },
+    {
+        'testcase_name': 'nested_more_specific',
+        'filenames': [
+            'images/im_included.png',
+            'images/include/images/im_included.png',
+        ],
+        'contents': '\\include{images/include/images/im_included.png}',
+        'strict': False,
+        'true_outputs': ['images/include/images/im_included.png'],
+    },
+    {
+        'testcase_name': 'nested_less_specific',
+        'filenames': [
+            'images/im_included.png',
+            'images/include/images/im_included.png',
+        ],
+        'contents': '\\include{images/im_included.png}',
+        'strict': False,
+        'true_outputs': [
+            'images/im_included.png',
+            'images/include/images/im_included.png',
+        ],
+    },
+    {
+        'testcase_name': 'nested_substring',
+        'filenames': ['images/im_included.png', 'im_included.png'],
+        'contents': '\\include{images/im_included.png}',
+        'strict': False,
+        'true_outputs': ['images/im_included.png'],
+    },
+    {
+        'testcase_name': 'nested_diffpath',
+        'filenames': ['images/im_included.png', 'figures/im_included.png'],
+        'contents': '\\include{images/im_included.png}',
+        'strict': False,
+        'true_outputs': ['images/im_included.png'],
+    },
+    {
+        'testcase_name': 'diffext',
+        'filenames': ['tables/demo.tex', 'tables/demo.tikz', 'demo.tex'],
+        'contents': '\\include{tables/demo.tex}',
+        'strict': False,
+        'true_outputs': ['tables/demo.tex'],
+    },
+    {
+        'testcase_name': 'diffext2',
+        'filenames': ['tables/demo.tex', 'tables/demo.tikz', 'demo.tex'],
+        'contents': '\\include{tables/demo}',
+        'strict': False,
+        'true_outputs': ['tables/demo.tex', 'tables/demo.tikz'],
+    },
+    {
+        'testcase_name': 'strict_prefix1',
+        'filenames': ['demo_yes.tex', 'demo.tex'],
+        'contents': '\\include{demo_yes.tex}',
+        'strict': True,
+        'true_outputs': ['demo_yes.tex'],
+    },
+    {
+        'testcase_name': 'strict_prefix2',
+        'filenames': ['demo_yes.tex', 'demo.tex'],
+        'contents': '\\include{demo.tex}',
+        'strict': True,
+        'true_outputs': ['demo.tex'],
+    },
+    {
+        'testcase_name': 'strict_nested_more_specific',
+        'filenames': [
+            'tables/table_included.csv',
+            'tables/include/tables/table_included.csv',
+        ],
+        'contents': '\\include{tables/include/tables/table_included.csv}',
+        'strict': True,
+        'true_outputs': ['tables/include/tables/table_included.csv'],
+    },
+    {
+        'testcase_name': 'strict_nested_less_specific',
+        'filenames': [
+            'tables/table_included.csv',
+            'tables/include/tables/table_included.csv',
+        ],
+        'contents': '\\include{tables/table_included.csv}',
+        'strict': True,
+        'true_outputs': ['tables/table_included.csv'],
+    },
+    {
+        'testcase_name': 'strict_nested_substring1',
+        'filenames': ['tables/table_included.csv', 'table_included.csv'],
+        'contents': '\\include{tables/table_included.csv}',
+        'strict': True,
+        'true_outputs': ['tables/table_included.csv'],
+    },
+    {
+        'testcase_name': 'strict_nested_substring2',
+        'filenames': ['tables/table_included.csv', 'table_included.csv'],
+        'contents': '\\include{table_included.csv}',
+        'strict': True,
+        'true_outputs': ['table_included.csv'],
+    },
+    {
+        'testcase_name': 'strict_nested_diffpath',
+        'filenames': ['tables/table_included.csv', 'data/table_included.csv'],
+        'contents': '\\include{tables/table_included.csv}',
+        'strict': True,
+        'true_outputs': ['tables/table_included.csv'],
+    },
+    {
+        'testcase_name': 'strict_diffext',
+        'filenames': ['tables/demo.csv', 'tables/demo.txt', 'demo.csv'],
+        'contents': '\\include{tables/demo.csv}',
+        'strict': True,
+        'true_outputs': ['tables/demo.csv'],
+    },
+    {
+        'testcase_name': 'path_starting_with_dot',
+        'filenames': [
+            './images/im_included.png',
+            './figures/im_included.png',
+        ],
+        'contents': '\\include{./images/im_included.png}',
+        'strict': False,
+        'true_outputs': ['./images/im_included.png'],
+    },
+    {
+        'testcase_name': 'ignore_case_dotted_capital_i',
+        'filenames': ['figs/\u0130m.png', 'figs/im.png'],
+        'contents': '\\include{figs/im.png}',
+        'strict': False,
+        'true_outputs': ['figs/\u0130m.png', 'figs/im.png'],
+    },
+    {
+        'testcase_name': 'ignore_case_dotless_i',
+        'filenames': ['figs/Im.png', 'figs/im.png'],
+        'contents': '\\include{figs/\u0131m.png}',
+        'strict': False,
+        'true_outputs': ['figs/Im.png'],
+    },
+)
 
 
 class UnitTests(parameterized.TestCase):
@@ -319,6 +336,65 @@ class UnitTests(parameterized.TestCase):
         arxiv_latex_cleaner._remove_comments_inline(line_in), true_output
     )
 
+  @parameterized.named_parameters(
+      {
+          'testcase_name': 'no_comment',
+          'text_in': 'Foo\nFoo2',
+          'true_output': 'Foo\nFoo2\n',
+      },
+      {
+          'testcase_name': 'comments',
+          'text_in': 'Foo %Comment\n  % Comment\nFoo2\n% Last comment',
+          'true_output': 'Foo %\nFoo2\n',
+      },
+      {
+          'testcase_name': 'auto_ignore_and_url',
+          'text_in': (
+              '% auto-ignore Comment\n\\url{https://www.example.com/a%20b}\n'
+          ),
+          'true_output': (
+              '% auto-ignore\n\\url{https://www.example.com/a%20b}\n'
+          ),
+      },
+      {
+          'testcase_name': 'auto_ignore_last_line',
+          'text_in': 'Foo\n% auto-ignore Comment',
+          'true_output': 'Foo\n% auto-ignore',
+      },
+  )
+  def test_remove_comments(self, text_in, true_output):
+    self.assertEqual(
+        arxiv_latex_cleaner._remove_comments(text_in), true_output
+    )
+
+  @parameterized.named_parameters(
+      {
+          'testcase_name': 'no_end',
+          'text_in': 'Foo\nFoo2',
+          'true_output': 'Foo\nFoo2',
+      },
+      {
+          'testcase_name': 'end',
+          'text_in': 'Foo\n\\end{document}\nFoo2\n',
+          'true_output': 'Foo\n\\end{document}\n',
+      },
+      {
+          'testcase_name': 'commented_end',
+          'text_in': '% \\end{document}\nFoo\n\\end{document} % c\nFoo2\n',
+          'true_output': '% \\end{document}\nFoo\n\\end{document} % c\n',
+      },
+      {
+          'testcase_name': 'end_in_last_line',
+          'text_in': 'Foo\n\\end{document}',
+          'true_output': 'Foo\n\\end{document}',
+      },
+  )
+  def test_strip_tex_contents(self, text_in, true_output):
+    self.assertEqual(
+        arxiv_latex_cleaner._strip_tex_contents(text_in, '\\end{document}'),
+        true_output,
+    )
+
   @parameterized.named_parameters(
       {
           'testcase_name': 'no_command',
@@ -406,6 +482,18 @@ class UnitTests(parameterized.TestCase):
               'A\nB\n\\emph{C\\footnote{\\textbf{D}}}\nE\n\\end{document}'
           ),
       },
+      {
+          'testcase_name': 'command_with_braces_in_optional_argument_keep_text',
+          'text_in': 'A\n\\todo[{B}]{C}\nD\n\\end{document}',
+          'keep_text': True,
+          'true_output': 'A\nC\nD\n\\end{document}',
+      },
+      {
+          'testcase_name': 'unbalanced_command_not_removed',
+          'text_in': 'A\\todo' + '[B]' * 100 + '{C' * 100 + '\n',
+          'keep_text': False,
+          'true_output': 'A\\todo' + '[B]' * 100 + '{C' * 100 + '\n',
+      },
   )
   def test_remove_command(self, text_in, keep_text, true_output):
     self.assertEqual(
@@ -435,6 +523,34 @@ class UnitTests(parameterized.TestCase):
         arxiv_latex_cleaner._remove_environment(text_in, 'comment'), true_output
     )
 
+  @parameterized.named_parameters(
+      {
+          'testcase_name': 'different_commands',
+          'text_in': 'A\\todo{B}C\\note{D}E\n',
+          'true_output': 'ACE\n',
+      },
+      {
+          'testcase_name': 'nested_commands',
+          'text_in': 'A\\note{B\\todo{C}D}E\n',
+          'true_output': 'AE\n',
+      },
+      {
+          'testcase_name': 'nested_environments',
+          'text_in': 'A\\begin{note}\\begin{comment}B\\end{comment}C\\end{note}D',
+          'true_output': 'AD',
+      },
+  )
+  def test_remove_multiple_commands_and_environments(
+      self, text_in, true_output
+  ):
+    text_out = arxiv_latex_cleaner._remove_environments(
+        text_in, ['comment', 'note']
+    )
+    self.assertEqual(
+        arxiv_latex_cleaner._remove_commands(text_out, ['todo', 'note']),
+        true_output,
+    )
+
   @parameterized.named_parameters(
       {
           'testcase_name': 'no_iffalse',
@@ -567,6 +683,17 @@ class UnitTests(parameterized.TestCase):
               r'& \parbox[c]{\ww\linewidth}{\includegraphics[width=1.0\linewidth]{figures/image2.jpg}}'
           ),
       },
+      {
+          'testcase_name': 'replace_nested_macros',
+          'content': r'$\norm{x + \norm{y}}$',
+          'patterns_and_insertions': [{
+              'pattern': r'\\norm\{(?P<x>[^{}]*)\}',
+              'insertion': r'\lVert {x} \rVert',
+              'description': 'Replace norm',
+              'strip_whitespace': False,
+          }],
+          'true_outputs': r'$\lVert x + \lVert y \rVert \rVert$',
+      },
   )
   def test_find_and_replace_patterns(
       self, content, patterns_and_insertions, true_outputs
@@ -677,10 +804,8 @@ class UnitTests(parameterized.TestCase):
         true_output,
     )
 
-  @parameterized.named_parameters(*make_search_reference_tests())
-  def test_search_reference_weak(
-      self, filenames, contents, strict, true_outputs
-  ):
+  @parameterized.named_parameters(*SEARCH_REFERENCE_TESTS)
+  def test_search_reference(self, filenames, contents, strict, true_outputs):
     cleaner_outputs = []
     for filename in filenames:
       reference = arxiv_latex_cleaner._search_reference(
@@ -689,29 +814,22 @@ class UnitTests(parameterized.TestCase):
       if reference is not None:
         cleaner_outputs.append(filename)
 
-    # weak check (passes as long as cleaner includes a superset of the true_output)
+    # weak check (fatal if the cleaner misses any of the true_outputs)
     for true_output in true_outputs:
-      self.assertIn(true_output, cleaner_outputs)
-
-  @parameterized.named_parameters(*make_search_reference_tests())
-  def test_search_reference_strong(
-      self, filenames, contents, strict, true_outputs
-  ):
-    cleaner_outputs = []
-    for filename in filenames:
-      reference = arxiv_latex_cleaner._search_reference(
-          filename, contents, strict
-      )
-      if reference is not None:
-        cleaner_outputs.append(filename)
+      self.assertIn(true_output, cleaner_outputs, 'fatal, file not included')
 
     # strong check (set of files must match exactly)
-    weak_check_result = set(true_outputs).issubset(cleaner_outputs)
-    if weak_check_result:
-      msg = 'not fatal, cleaner included more files than necessary'
-    else:
-      msg = 'fatal, see test_search_reference_weak'
-    self.assertEqual(cleaner_outputs, true_outputs, msg)
+    self.assertEqual(
+        cleaner_outputs,
+        true_outputs,
+        'not fatal, cleaner included more files than necessary',
+    )
+
+    # the prefilter in _keep_only_referenced must not change the result
+    self.assertEqual(
+        arxiv_latex_cleaner._keep_only_referenced(filenames, contents, strict),
+        cleaner_outputs,
+    )
 
   @parameterized.named_parameters(
       {
@@ -872,15 +990,115 @@ class UnitTests(parameterized.TestCase):
       msg = msg_fmt.format(filename, content)
       self.assertEqual(matched, true_output, msg)
 
+  @parameterized.named_parameters(
+      {
+          'testcase_name': 'root_prefix_of_another_root',
+          'contents': {
+              'main.tex': '\\input{sub/a.b}\n',
+              'sub/a.tex': '',
+              'sub/a.b.tex': '',
+          },
+          'true_output': ['main.tex', 'sub/a.b.tex', 'sub/a.tex'],
+      },
+      {
+          'testcase_name': 'root_with_tex_extension',
+          'contents': {
+              'main.tex': '\\input{figs/x.tex}\n',
+              'figs/x.tex': '',
+              'figs/x.tex.tikz': '',
+          },
+          'true_output': ['figs/x.tex', 'figs/x.tex.tikz', 'main.tex'],
+      },
+      {
+          'testcase_name': 'referenced_only_from_unreferenced',
+          'contents': {
+              'main.tex': '\\input{sub/used}\n',
+              'sub/used.tex': '',
+              'sub/orphan.tex': '\\input{sub/unused}\n',
+              'sub/unused.tex': '',
+          },
+          'true_output': ['main.tex', 'sub/used.tex'],
+      },
+  )
+  def test_keep_only_referenced_tex(self, contents, true_output):
+    splits = {
+        'tex_in_root': [fn for fn in contents if '/' not in fn],
+        'tex_not_in_root': [fn for fn in contents if '/' in fn],
+    }
+    arxiv_latex_cleaner._keep_only_referenced_tex(contents, splits)
+    self.assertEqual(sorted(splits['tex_to_copy']), true_output)
+
+  @parameterized.named_parameters(
+      {
+          'testcase_name': 'same_folder',
+          'path': 'C:/papers/paper',
+          'folder': 'C:/papers/paper',
+          'true_output': True,
+      },
+      {
+          'testcase_name': 'parent_folder',
+          'path': 'C:/papers/paper',
+          'folder': 'C:/papers',
+          'true_output': True,
+      },
+      {
+          'testcase_name': 'sibling_folder',
+          'path': 'C:/papers/paper',
+          'folder': 'C:/papers/paper_arXiv',
+          'true_output': False,
+      },
+      {
+          'testcase_name': 'other_drive',
+          'path': 'C:/papers/paper',
+          'folder': 'D:/',
+          'true_output': False,
+      },
+  )
+  def test_is_same_or_inside(self, path, folder, true_output):
+    self.assertEqual(
+        arxiv_latex_cleaner._is_same_or_inside(
+            pathlib.PureWindowsPath(path), pathlib.PureWindowsPath(folder)
+        ),
+        true_output,
+    )
+
+  @parameterized.named_parameters(
+      {'testcase_name': 'from_dir', 'input_name': 'paper'},
+      {'testcase_name': 'from_zip', 'input_name': 'paper.zip'},
+  )
+  def test_create_out_folder_default(self, input_name):
+    parent = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, parent)
+    out_folder = arxiv_latex_cleaner._create_out_folder(
+        path.join(parent, input_name)
+    )
+    self.assertEqual(out_folder, path.join(parent, 'paper_arXiv'))
+    self.assertTrue(path.isdir(out_folder))
+
+  @parameterized.named_parameters(
+      {'testcase_name': 'same_folder', 'output_name': 'paper'},
+      {'testcase_name': 'parent_folder', 'output_name': '.'},
+  )
+  def test_create_out_folder_refuses_input(self, output_name):
+    parent = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, parent)
+    input_folder = path.join(parent, 'paper')
+    os.makedirs(input_folder)
+    with self.assertRaises(ValueError):
+      arxiv_latex_cleaner._create_out_folder(
+          input_folder, path.join(parent, output_name)
+      )
+    self.assertTrue(path.isdir(input_folder))
+
 
 class IntegrationTests(parameterized.TestCase):
 
   def setUp(self):
     super(IntegrationTests, self).setUp()
-    self.out_path = 'tex_arXiv'
+    self.out_path = tempfile.mkdtemp()
 
   def _compare_files(self, filename, filename_true):
-    if path.splitext(filename)[1].lower() in ['.jpg', '.jpeg', '.png']:
+    if filename.lower().endswith(('.jpg', '.jpeg', '.png')):
       with Image.open(filename) as im, Image.open(filename_true) as im_true:
         # We check only the sizes of the images, checking pixels would be too
         # complicated in case the resize implementations change.
@@ -889,9 +1107,9 @@ class IntegrationTests(parameterized.TestCase):
             im_true.size,
             'Images {:s} was not resized properly.'.format(filename),
         )
-    else:
-      # Checks if text files are equal without taking in account end of line
-      # characters.
+    elif not filecmp.cmp(filename, filename_true, shallow=False):
+      # Text files that are not byte-identical are compared without taking in
+      # account end of line characters.
       with open(filename, 'rb') as f:
         processed_content = f.read().splitlines()
       with open(filename_true, 'rb') as f:
@@ -910,14 +1128,9 @@ class IntegrationTests(parameterized.TestCase):
   def test_complete(self, input_dir):
     out_path_true = 'tex_arXiv_true'
 
-    # Make sure the folder does not exist, since we erase it in the test.
-    if path.isdir(self.out_path):
-      raise RuntimeError(
-          'The folder {:s} should not exist.'.format(self.out_path)
-      )
-
     arxiv_latex_cleaner.run_arxiv_cleaner({
         'input_folder': input_dir,
+        'output_folder': self.out_path,
         'images_allowlist': {
             'images/im2_included.jpg': 200,
             'images/im3_included.png': 400,